@@ -30,6 +30,23 @@ class DynamicsModel(abc.ABC, nn.Module):
         """
         pass
 
+    def forward_flat(self, states_prev, controls, noisy=False):
+        """
+        Predict the current state from the previous one + our control input,
+        for a single state per trajectory. Subclasses can override this to
+        skip the particle dimension.
+
+        Parameters:
+            states_prev (torch.Tensor): (N, state_dim) states at time `t - 1`
+            controls (torch.Tensor): (N, control_dim) control inputs at time `t`
+            noisy (bool): whether or not we should inject noise.
+        Returns:
+            states (torch.Tensor): (N, state_dim) states at time `t`
+        """
+        return self.forward(
+            states_prev[:, np.newaxis, :], controls, noisy=noisy
+        ).squeeze(dim=1)
+
 
 class ParticleFilterNetwork(nn.Module):
 
@@ -49,11 +66,13 @@ class ParticleFilterNetwork(nn.Module):
     def forward(self, states_prev, log_weights_prev, observations, controls,
                 resample=True, output_particles=None,
                 state_estimation_method="weighted_average",
-                noisy_dynamics=True):
+                noisy_dynamics=True, observation_features=None):
         # states_prev: (N, M, *)
         # log_weights_prev: (N, M)
         # observations: (N, *)
         # controls: (N, *)
+        # observation_features: (N, *), optional; precomputed by our
+        #   measurement model's `encode_observations()`
         #
         # N := distinct trajectory count
         # M := particle count
@@ -91,8 +110,13 @@ class ParticleFilterNetwork(nn.Module):
             states_pred = states_pred.detach()
 
         # Re-weight particles using observations
-        observation_log_likelihoods = self.measurement_model(
-            observations, states_pred)
+        if observation_features is None:
+            observation_log_likelihoods = self.measurement_model(
+                observations, states_pred)
+        else:
+            observation_log_likelihoods = self.measurement_model(
+                observations, states_pred,
+                observation_features=observation_features)
         if self.freeze_measurement_model:
             # Don't backprop through frozen models
             observation_log_likelihoods = observation_log_likelihoods.detach()
@@ -157,8 +181,9 @@ class ParticleFilterNetwork(nn.Module):
                 #     states[i] = states_pred[i][indices]
 
                 # Uniform weights
-                log_weights = torch.zeros(
-                    (N, output_particles), device=device) - np.log(output_particles)
+                log_weights = torch.full(
+                    (N, output_particles), -np.log(output_particles),
+                    device=device)
         else:
             # Just use predicted states as output
             states = states_pred
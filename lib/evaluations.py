@@ -6,7 +6,7 @@ import torch.nn.functional as F
 import time
 
 import fannypack
-from lib import dpf, panda_models, panda_datasets, panda_kf_training, omnipush_datasets
+from lib import dpf, panda_models, panda_datasets, panda_kf_training, omnipush_datasets, utility
 
 from lib.ekf import KalmanFilterNetwork
 from lib import dpf
@@ -104,22 +104,13 @@ def rollout_kf(kf_model, trajectories, start_time=0, max_timesteps=300,
     predicted_sigmas = [[utils.to_numpy(initial_sigmas[i])]
                         for i in range(len(trajectories))]
 
-    for t in tqdm(range(start_time + 1, end_time)):
-        s = []
-        o = {}
-        c = []
-
-        for i, traj in enumerate(trajectories):
-            s, observations, controls = traj
+    # (N, t, *)
+    (all_observations, all_controls) = utility.stack_trajectories(
+        trajectories, start_time, end_time, device)
 
-            o_t = utils.DictIterator(observations)[t]
-            utils.DictIterator(o).append(o_t)
-            c.append(controls[t])
-
-        s = np.array(s)
-        utils.DictIterator(o).convert_to_numpy()
-        c = np.array(c)
-        (s, o, c) = utils.to_torch((s, o, c), device=device)
+    for t in tqdm(range(start_time + 1, end_time)):
+        o = utils.DictIterator(all_observations)[:, t - start_time]
+        c = all_controls[:, t - start_time]
 
         estimates = kf_model.forward(
             states,
@@ -253,22 +244,13 @@ def rollout_kf_full(kf_model, trajectories, start_time=0, max_timesteps=300,
     # jacobian is not initialized
     predicted_jac = [[] for i in range(len(trajectories))]
 
-    for t in tqdm(range(start_time + 1, end_time)):
-        s = []
-        o = {}
-        c = []
-
-        for i, traj in enumerate(trajectories):
-            s, observations, controls = traj
-
-            o_t = utils.DictIterator(observations)[t]
-            utils.DictIterator(o).append(o_t)
-            c.append(controls[t])
+    # (N, t, *)
+    (all_observations, all_controls) = utility.stack_trajectories(
+        trajectories, start_time, end_time, device)
 
-        s = np.array(s)
-        utils.DictIterator(o).convert_to_numpy()
-        c = np.array(c)
-        (s, o, c) = utils.to_torch((s, o, c), device=device)
+    for t in tqdm(range(start_time + 1, end_time)):
+        o = utils.DictIterator(all_observations)[:, t - start_time]
+        c = all_controls[:, t - start_time]
 
         estimates = kf_model.forward(
             states,
@@ -419,28 +401,18 @@ def rollout_fusion(kf_model, trajectories, start_time=0, max_timesteps=300,
     predicted_contacts = [[np.zeros(1)]
                           for i in range(len(trajectories))]
 
-    for t in tqdm(range(start_time + 1, end_time)):
-        s = []
-        o = {}
-        c = []
-
-        for i, traj in enumerate(trajectories):
-            s, observations, controls = traj
-
-            o_t = utils.DictIterator(observations)[t]
-            utils.DictIterator(o).append(o_t)
-            c.append(controls[t])
+    # (N, t, *)
+    (all_observations, all_controls) = utility.stack_trajectories(
+        trajectories, start_time, end_time, device)
 
-        s = np.array(s)
-        utils.DictIterator(o).convert_to_numpy()
-
-        c = np.array(c)
-        (s, o_torch, c) = utils.to_torch((s, o, c), device=device)
+    for t in tqdm(range(start_time + 1, end_time)):
+        o = utils.DictIterator(all_observations)[:, t - start_time]
+        c = all_controls[:, t - start_time]
 
         estimates = kf_model.forward(
             states,
             sigmas,
-            o_torch,
+            o,
             c,
             return_all=True
         )
@@ -125,7 +125,7 @@ class ParticleFusionModel(nn.Module):
                 states[i] = states_pred[i][state_indices[i]]
 
             # Uniform weights
-            log_weights = torch.zeros((N, M), device=device) - np.log(M)
+            log_weights = torch.full((N, M), -np.log(M), device=device)
         else:
             states = states_pred
             log_weights = log_weights_pred
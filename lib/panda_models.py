@@ -9,6 +9,10 @@ from . import dpf
 
 from utils import spatial_softmax
 
+# Shape checks in our forward passes run once per filter step, which adds up
+# over long rollouts; they're only evaluated when this is set
+_DEBUG = False
+
 
 class PandaParticleFilterNetwork(dpf.ParticleFilterNetwork):
     def __init__(self, dynamics_model, measurement_model, **kwargs):
@@ -29,37 +33,63 @@ class PandaSimpleDynamicsModel(dpf.DynamicsModel):
         else:
             self.state_noise_stddev = self.default_state_noise_stddev
 
+    @property
+    def state_noise_stddev(self):
+        return self._state_noise_stddev
+
+    @state_noise_stddev.setter
+    def state_noise_stddev(self, state_noise_stddev):
         # Convert scalar noise values to arrays
-        if type(self.state_noise_stddev) == float:
-            self.state_noise_stddev = np.array(
-                [self.state_noise_stddev] * state_dim)
+        if type(state_noise_stddev) == float:
+            state_noise_stddev = np.array(
+                [state_noise_stddev] * self.state_dim)
+        self._state_noise_stddev = state_noise_stddev
+
+        # Keep our noise scale on the same device as the model, so we can
+        # sample without any host => device copies
+        # This is refreshed whenever our noise is changed
+        device = self.noise_std.device if hasattr(self, "noise_std") else None
+        self.register_buffer(
+            "noise_std",
+            torch.tensor(state_noise_stddev, dtype=torch.float32,
+                         device=device),
+            persistent=False)
 
     def forward(self, states_prev, controls, noisy=False):
         # states_prev:  (N, M, state_dim)
         # controls: (N, control_dim)
 
-        assert len(states_prev.shape) == 3  # (N, M, state_dim)
+        if _DEBUG:
+            assert len(states_prev.shape) == 3  # (N, M, state_dim)
 
         # N := distinct trajectory count
         # M := particle count
         N, M, state_dim = states_prev.shape
-        assert state_dim == len(self.state_noise_stddev)
+        if _DEBUG:
+            assert state_dim == len(self.state_noise_stddev)
 
         states_new = states_prev
 
         # Add noise if desired
         if noisy:
-            dist = torch.distributions.Normal(
-                torch.zeros(self.state_dim, dtype=torch.float32),
-                torch.FloatTensor(self.state_noise_stddev))
-
-            noise = dist.sample((N, M)).to(states_new.device)
-            assert noise.shape == (N, M, state_dim)
+            noise = torch.randn(
+                (N, M, state_dim),
+                device=states_new.device,
+                dtype=states_new.dtype) * self.noise_std
+            if _DEBUG:
+                assert noise.shape == (N, M, state_dim)
             states_new = states_new + noise
 
             # Project to valid cosine/sine space
-            scale = torch.norm(states_new[:, :, 2:4], keepdim=True)
-            states_new[:, :, 2:4] /= scale
+            # Note that we normalize each particle independently
+            cos_sin = states_new[:, :, 2:4]
+            inv_scale = torch.rsqrt(torch.clamp(
+                torch.sum(cos_sin * cos_sin, dim=-1, keepdim=True), min=1e-12))
+            states_new = torch.cat(
+                (states_new[:, :, :2],
+                 cos_sin * inv_scale,
+                 states_new[:, :, 4:]),
+                dim=-1)
 
         # Return (N, M, state_dim)
         return states_new
@@ -119,62 +149,86 @@ class PandaDynamicsModel(dpf.DynamicsModel):
         self.learnable_Q = learnable_Q
         self.Q_l = torch.nn.Parameter(Q_l, requires_grad=self.learnable_Q)
 
+    @property
+    def Q(self):
+        # (state_dim, state_dim) process noise covariance
+        # Only our Kalman filters need this, so we build it on demand instead
+        # of on every forward pass
+        return torch.diag(self.Q_l ** 2)
+
     def forward(self, states_prev, controls, noisy=False):
         # states_prev:  (N, M, state_dim)
         # controls: (N, control_dim)
 
-        self.jacobian = False
-        if self.use_particles:
-            assert len(states_prev.shape) == 3  # (N, M, state_dim)
-            N, M, state_dim = states_prev.shape
-            dimensions = (N, M)
-        else:
-            if len(states_prev.shape) > 2:
-                #this is due to mask for jacobian
-                N, X, state_dim = states_prev.shape
-                dimensions = (N, X)
-                self.jacobian = True
-            else:
-                assert len(states_prev.shape) == 2  # (N, M, state_dim)
-                N, state_dim = states_prev.shape
-                dimensions = (N,)
+        if _DEBUG:
+            if self.use_particles:
+                assert len(states_prev.shape) == 3  # (N, M, state_dim)
+            elif len(states_prev.shape) == 2:
                 assert len(controls.shape) == 2  # (N, control_dim,)
 
+        # (N, M) with particles, (N, X) for our EKF's batched Jacobians, or
+        # just (N,)
+        dimensions = tuple(states_prev.shape[:-1])
+
+        return self._predict(states_prev, controls, dimensions, noisy)
+
+    def forward_flat(self, states_prev, controls, noisy=False):
+        # states_prev:  (N, state_dim)
+        # controls: (N, control_dim)
+
+        # With a single state per trajectory, we can skip the particle
+        # dimension entirely
+        if _DEBUG:
+            assert len(states_prev.shape) == 2  # (N, state_dim)
+            assert len(controls.shape) == 2  # (N, control_dim)
+        return self._predict(
+            states_prev, controls, states_prev.shape[:1], noisy)
+
+    def _predict(self, states_prev, controls, dimensions, noisy):
+        # states_prev:  (*dimensions, state_dim)
+        # controls: (N, control_dim) or (*dimensions, control_dim)
+
         # N := distinct trajectory count
         # M := particle count
+        state_dim = states_prev.shape[-1]
 
-        # (N, control_dim) => (N, units // 2)
+        # (N, control_dim) => (N, units)
         control_features = self.control_layers(controls)
 
-        # (N, units // 2) => (N, M, units // 2)
-        if self.use_particles:
-            control_features = control_features[:, np.newaxis, :].expand(
-                N, M, self.units)
-            assert control_features.shape == (N, M, self.units)
-
-        # (N, M, state_dim) => (N, M, units // 2)
+        # (N, M, state_dim) => (N, M, units)
         state_features = self.state_layers(states_prev)
-        assert state_features.shape == dimensions + (self.units, )
-
-        # (N, M, units)
-        merged_features = torch.cat(
-            (control_features, state_features),
-            dim=-1)
-        assert merged_features.shape == dimensions + (self.units * 2, )
+        if _DEBUG:
+            assert state_features.shape == dimensions + (self.units, )
 
-        # (N, M, units * 2) => (N, M, state_dim + 1)
-        output_features = self.shared_layers(merged_features)
+        # Our first shared layer is a linear map applied to the concatenated
+        # (control, state) features; we apply it to each half separately and
+        # sum, which lets us skip expanding our control features to
+        # (N, M, units) and computes the control half once per trajectory
+        #
+        # (N, units), (N, M, units) => (N, M, units)
+        merge_layer = self.shared_layers[0]
+        control_weight = merge_layer.weight[:, :self.units]
+        state_weight = merge_layer.weight[:, self.units:]
+        control_term = F.linear(
+            control_features, control_weight, merge_layer.bias)
+        if len(controls.shape) < len(states_prev.shape):
+            # Broadcast across particles
+            control_term = control_term[:, np.newaxis, :]
+        merged_features = control_term + \
+            F.linear(state_features, state_weight)
+        if _DEBUG:
+            assert merged_features.shape == dimensions + (self.units, )
+
+        # (N, M, units) => (N, M, state_dim + 1)
+        output_features = self.shared_layers[1:](merged_features)
 
         # We separately compute a direction for our network and a "gate"
         # These are multiplied to produce our final state output
-        if self.use_particles or self.jacobian:
-            state_update_direction = output_features[:, :, :state_dim]
-            state_update_gate = torch.sigmoid(output_features[:, :, -1:])
-        else:
-            state_update_direction = output_features[:, :state_dim]
-            state_update_gate = torch.sigmoid(output_features[:, -1:])
+        state_update_direction = output_features[..., :state_dim]
+        state_update_gate = torch.sigmoid(output_features[..., -1:])
         state_update = state_update_direction * state_update_gate
-        assert state_update.shape == dimensions + (state_dim,)
+        if _DEBUG:
+            assert state_update.shape == dimensions + (state_dim,)
 
         # Compute new states
 
@@ -187,23 +241,22 @@ class PandaDynamicsModel(dpf.DynamicsModel):
         # states_new[update_dims] += state_update
 
         states_new = states_prev + state_update
-        assert states_new.shape == dimensions + (state_dim,)
-
-        self.Q = torch.diag(self.Q_l**2)
+        if _DEBUG:
+            assert states_new.shape == dimensions + (state_dim,)
 
         # print("q: ", self.Q)
         # Add noise if desired
         if noisy:
-            dist = torch.distributions.MultivariateNormal(
-                torch.zeros(self.state_dim, dtype=torch.float32).to(states_new.device),
-                self.Q,)
-            # Taking sqrt of the covariance matrix since it is diagonal...
-            # Normal takes in std instead of variance
-            if self.learnable_Q:
-                noise = dist.rsample(dimensions)
-            else:
-                noise = dist.sample(dimensions)
-            assert noise.shape == dimensions + (state_dim,)
+            # Q is diagonal, so we can sample directly using our standard
+            # deviations -- this avoids building a distribution (and a
+            # Cholesky decomposition) on every call
+            Q_l = self.Q_l if self.learnable_Q else self.Q_l.detach()
+            noise = torch.randn(
+                dimensions + (state_dim,),
+                device=states_new.device,
+                dtype=states_new.dtype) * Q_l
+            if _DEBUG:
+                assert noise.shape == dimensions + (state_dim,)
             states_new = states_new + noise
 
         # Return (N, M, state_dim)
@@ -296,52 +349,90 @@ class PandaMeasurementModel(dpf.MeasurementModel):
 
         self.units = units
 
-    def forward(self, observations, states):
+    def encode_observations(self, observations):
+        """
+        Computes observation features, which are independent of our
+        particles. Leading batch dimensions are arbitrary, so features for
+        every timestep in a batch of subsequences can be computed at once.
+
+        Parameters:
+            observations (dict): (*, ...) observations
+        Returns:
+            observation_features (torch.Tensor): (*, obs_features) features
+        """
         assert type(observations) == dict
-        assert len(states.shape) == 3  # (N, M, state_dim)
-        assert states.shape[2] == self.state_dim
 
-        # N := distinct trajectory count
-        # M := particle count
-        N, M, _ = states.shape
-
-        # Construct observations feature vector
-        # (N, obs_dim)
+        # Flatten batch dimensions, then construct observations feature vector
+        # (*, obs_dim) => (N', obs_features)
         obs = []
         if "image" in self.modalities:
+            image = observations['image']
+            batch_shape = image.shape[:-2]
             obs.append(self.observation_image_layers(
-                observations['image'][:, np.newaxis, :, :]))
+                image.reshape((-1, 1) + image.shape[-2:])))
 
         if "gripper_pos" in self.modalities:
+            gripper_pos = observations['gripper_pos']
+            batch_shape = gripper_pos.shape[:-1]
             obs.append(self.observation_pos_layers(
-                observations['gripper_pos']))
+                gripper_pos.reshape((-1, gripper_pos.shape[-1]))))
 
         if "gripper_sensors" in self.modalities:
+            gripper_sensors = observations['gripper_sensors']
+            batch_shape = gripper_sensors.shape[:-1]
             obs.append(self.observation_sensors_layers(
-                observations['gripper_sensors']))
+                gripper_sensors.reshape((-1, gripper_sensors.shape[-1]))))
 
         observation_features = torch.cat(obs, dim=1)
 
-        # (N, obs_features) => (N, M, obs_features)
-        observation_features = observation_features[:, np.newaxis, :].expand(
-            N, M, self.units * len(self.modalities))
-        assert observation_features.shape == (
-            N, M, self.units * len(self.modalities))
+        # (N', obs_features) => (*, obs_features)
+        return observation_features.reshape(
+            batch_shape + (self.units * len(self.modalities), ))
+
+    def forward(self, observations, states, observation_features=None):
+        assert type(observations) == dict
+        if _DEBUG:
+            assert len(states.shape) == 3  # (N, M, state_dim)
+            assert states.shape[2] == self.state_dim
+
+        # N := distinct trajectory count
+        # M := particle count
+        N, M, _ = states.shape
+
+        # Construct observations feature vector, if it wasn't passed in
+        # (N, obs_dim) => (N, obs_features)
+        if observation_features is None:
+            observation_features = self.encode_observations(observations)
+        if _DEBUG:
+            assert observation_features.shape == (
+                N, self.units * len(self.modalities))
 
         # (N, M, state_dim) => (N, M, units)
         state_features = self.state_layers(states)
         # state_features = self.state_layers(states * torch.tensor([[[1., 0.]]], device=states.device))
-        assert state_features.shape == (N, M, self.units)
+        if _DEBUG:
+            assert state_features.shape == (N, M, self.units)
 
-        merged_features = torch.cat(
-            (observation_features, state_features),
-            dim=2)
-        assert merged_features.shape == (
-            N, M, self.units * (len(self.modalities) + 1))
-
-        # (N, M, merged_dim) => (N, M, 1)
-        log_likelihoods = self.shared_layers(merged_features)
-        assert log_likelihoods.shape == (N, M, 1)
+        # Apply our first shared layer to the observation and state halves of
+        # its input separately, instead of expanding our observation features
+        # to (N, M, obs_features) and concatenating
+        #
+        # (N, obs_features), (N, M, units) => (N, M, units)
+        obs_dim = self.units * len(self.modalities)
+        merge_layer = self.shared_layers[0]
+        observation_term = F.linear(
+            observation_features,
+            merge_layer.weight[:, :obs_dim],
+            merge_layer.bias)
+        merged_features = observation_term[:, np.newaxis, :] + \
+            F.linear(state_features, merge_layer.weight[:, obs_dim:])
+        if _DEBUG:
+            assert merged_features.shape == (N, M, self.units)
+
+        # (N, M, units) => (N, M, 1)
+        log_likelihoods = self.shared_layers[1:](merged_features)
+        if _DEBUG:
+            assert log_likelihoods.shape == (N, M, 1)
 
         # Return (N, M)
         return torch.squeeze(log_likelihoods, dim=2)
@@ -458,7 +549,8 @@ class PandaEKFMeasurementModel(dpf.MeasurementModel):
         # N := distinct trajectory count (batch size)
 
         N = observations['image'].shape[0]
-        assert states.shape == (N, self.state_dim)
+        if _DEBUG:
+            assert states.shape == (N, self.state_dim)
 
         # Construct observations feature vector
         # (N, obs_dim)
@@ -476,19 +568,23 @@ class PandaEKFMeasurementModel(dpf.MeasurementModel):
 
         observation_features = torch.cat(obs, dim=1)
         # missing modalities
-        assert observation_features.shape == (
-            N, self.units * len(self.modalities))
+        if _DEBUG:
+            assert observation_features.shape == (
+                N, self.units * len(self.modalities))
 
         shared_features = self.shared_layers(observation_features)
-        assert shared_features.shape == (N, self.units * 2)
+        if _DEBUG:
+            assert shared_features.shape == (N, self.units * 2)
 
         shared_features_z = shared_features[:, :self.units].clone()
         z = self.z_layer(shared_features_z)
-        assert z.shape == (N, self.state_dim)
+        if _DEBUG:
+            assert z.shape == (N, self.state_dim)
 
         lt_hat = self.r_layer(shared_features[:, self.units:].clone())
         lt = torch.diag_embed(lt_hat, offset=0, dim1=-2, dim2=-1)
-        assert lt.shape == (N, self.state_dim, self.state_dim)
+        if _DEBUG:
+            assert lt.shape == (N, self.state_dim, self.state_dim)
 
         R = lt ** 2
 
@@ -637,7 +733,8 @@ class PandaEKFMeasurementModel2GAP(PandaEKFMeasurementModel):
         # N := distinct trajectory count (batch size)
 
         N = observations['image'].shape[0]
-        assert states.shape == (N, self.state_dim)
+        if _DEBUG:
+            assert states.shape == (N, self.state_dim)
         # Construct observations feature vector
         # (N, obs_dim)
         obs = []
@@ -659,19 +756,23 @@ class PandaEKFMeasurementModel2GAP(PandaEKFMeasurementModel):
 
         observation_features = torch.cat(obs, dim=1)
         # missing modalities
-        assert observation_features.shape == (
-            N, self.units * len(self.modalities))
+        if _DEBUG:
+            assert observation_features.shape == (
+                N, self.units * len(self.modalities))
 
         shared_features = self.shared_layers(observation_features)
-        assert shared_features.shape == (N, self.units * 2)
+        if _DEBUG:
+            assert shared_features.shape == (N, self.units * 2)
 
         shared_features_z = shared_features[:, :self.units].clone()
         z = self.z_layer(shared_features_z)
-        assert z.shape == (N, self.state_dim)
+        if _DEBUG:
+            assert z.shape == (N, self.state_dim)
 
         lt_hat = self.r_layer(shared_features[:, self.units:].clone())
         lt = torch.diag_embed(lt_hat, offset=0, dim1=-2, dim2=-1)
-        assert lt.shape == (N, self.state_dim, self.state_dim)
+        if _DEBUG:
+            assert lt.shape == (N, self.state_dim, self.state_dim)
 
         R = lt ** 2
 
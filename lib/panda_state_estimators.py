@@ -127,7 +127,7 @@ class DPFStateEstimator(StateEstimator):
         particles = np.zeros((1, M, 1))
         particles[:] = door_pos
         particles = utils.to_torch(particles, device=self.buddy._device)
-        log_weights = torch.ones((1, M), device=self.buddy._device) * (-np.log(M))
+        log_weights = torch.full((1, M), -np.log(M), device=self.buddy._device)
 
         self.particles = particles
         self.log_weights = log_weights
@@ -6,13 +6,28 @@ from tqdm.auto import tqdm
 
 from fannypack import utils
 
-from . import dpf
+from . import dpf, utility
+
+# Enables shape checks inside our per-timestep training loops
+_DEBUG = False
+
+
+def _compile_pf_model(pf_model, **kwargs):
+    """Wraps a particle filter with `torch.compile`; if our version of
+    PyTorch doesn't have it, we just run the model eagerly.
+    """
+    if not hasattr(torch, "compile"):
+        return pf_model
+    return torch.compile(pf_model, **kwargs)
 
 
 def train_dynamics_recurrent(buddy, pf_model, dataloader, log_interval=10,
-                             loss_type="l1", optim_name="dynamics_recurrent"):
+                             loss_type="l1", optim_name="dynamics_recurrent",
+                             teacher_force=False):
 
     assert loss_type in ('l1', 'l2', 'huber', 'peter')
+    if teacher_force:
+        assert loss_type != 'peter', "not implemented!"
 
     # Train dynamics only for 1 epoch
     # Train for 1 epoch
@@ -31,83 +46,114 @@ def train_dynamics_recurrent(buddy, pf_model, dataloader, log_interval=10,
         assert prev_states.shape == (N, state_dim)
 
         # Accumulate losses from each timestep
-        losses = []
+        loss_accum = torch.zeros((), device=buddy._device)
         magnitude_losses = []
         direction_losses = []
 
         # Compute some state deltas for debugging
-        label_deltas = np.mean(utils.to_numpy(
-            batch_states[:, 1:, :] - batch_states[:, :-1, :]
-        ) ** 2, axis=(0, 2))
+        # These stay on the GPU until we log them, to avoid syncing every step
+        label_deltas = torch.mean(
+            (batch_states[:, 1:, :] - batch_states[:, :-1, :]) ** 2,
+            dim=(0, 2))
         assert label_deltas.shape == (timesteps - 1, )
         pred_deltas = []
 
-        for t in range(1, timesteps):
-            # Propagate current states through dynamics model
-            controls = batch_controls[:, t, :]
-            new_states = pf_model.dynamics_model(
-                prev_states[:, np.newaxis, :],  # Add particle dimension
-                controls,
+        if teacher_force:
+            # Feed in ground-truth previous states at every timestep; since
+            # no timestep depends on our previous prediction, we can run them
+            # all through our dynamics model at once
+            # (N, timesteps - 1, *) => (N * (timesteps - 1), *)
+            new_states = pf_model.dynamics_model.forward_flat(
+                batch_states[:, :-1, :].reshape((-1, state_dim)),
+                batch_controls[:, 1:, :].reshape((-1, control_dim)),
                 noisy=False,
-            ).squeeze(dim=1)  # Remove particle dimension
-            assert new_states.shape == (N, state_dim)
-
-            # Compute deltas
-            pred_delta = prev_states - new_states
-            label_delta = batch_states[:, t - 1, :] - batch_states[:, t, :]
-            assert pred_delta.shape == (N, state_dim)
-            assert label_delta.shape == (N, state_dim)
+            ).reshape((N, timesteps - 1, state_dim))
+            label_states = batch_states[:, 1:, :]
 
-            # Compute and add loss
+            # Compute loss
             if loss_type == 'l1':
-                # timestep_loss = F.l1_loss(pred_delta, label_delta)
-                timestep_loss = F.l1_loss(new_states, batch_states[:, t, :])
+                loss = F.l1_loss(new_states, label_states)
             elif loss_type == 'l2':
-                # timestep_loss = F.mse_loss(pred_delta, label_delta)
-                timestep_loss = F.mse_loss(new_states, batch_states[:, t, :])
+                loss = F.mse_loss(new_states, label_states)
             elif loss_type == 'huber':
-                # Note that the units our states are in will affect results
-                # for Huber
-                timestep_loss = F.smooth_l1_loss(
-                    batch_states[:, t, :], new_states)
-            elif loss_type == 'peter':
-                # Use a Peter loss
-                # Currently broken
-                assert False
-
-                pred_magnitude = torch.norm(pred_delta, dim=1)
-                label_magnitude = torch.norm(label_delta, dim=1)
-                assert pred_magnitude.shape == (N, )
-                assert label_magnitude.shape == (N, )
-
-                # pred_direction = pred_delta / (pred_magnitude + 1e-8)
-                # label_direction = label_delta / (label_magnitude + 1e-8)
-                # assert pred_direction.shape == (N, state_dim)
-                # assert label_direction.shape == (N, state_dim)
-
-                # Compute loss
-                magnitude_loss = F.mse_loss(pred_magnitude, label_magnitude)
-                # direction_loss =
-                timestep_loss = magnitude_loss + direction_loss
-
-                magnitude_losses.append(magnitude_loss)
-                direction_losses.append(direction_loss)
-
+                loss = F.smooth_l1_loss(label_states, new_states)
             else:
                 assert False
-            losses.append(timestep_loss)
-
-            # Compute delta and update states
-            pred_deltas.append(np.mean(
-                utils.to_numpy(new_states - prev_states) ** 2
-            ))
-            prev_states = new_states
-
-        pred_deltas = np.array(pred_deltas)
-        assert pred_deltas.shape == (timesteps - 1, )
 
-        loss = torch.mean(torch.stack(losses))
-        epoch_losses.append(loss)
+            pred_deltas = torch.mean(
+                (new_states - batch_states[:, :-1, :]).detach() ** 2,
+                dim=(0, 2))
+            assert pred_deltas.shape == (timesteps - 1, )
+        else:
+            for t in range(1, timesteps):
+                # Propagate current states through dynamics model
+                controls = batch_controls[:, t, :]
+                new_states = pf_model.dynamics_model.forward_flat(
+                    prev_states,
+                    controls,
+                    noisy=False,
+                )
+                if _DEBUG:
+                    assert new_states.shape == (N, state_dim)
+
+                # Compute deltas
+                pred_delta = prev_states - new_states
+                label_delta = batch_states[:, t - 1, :] - batch_states[:, t, :]
+                if _DEBUG:
+                    assert pred_delta.shape == (N, state_dim)
+                    assert label_delta.shape == (N, state_dim)
+
+                # Compute and add loss
+                if loss_type == 'l1':
+                    # timestep_loss = F.l1_loss(pred_delta, label_delta)
+                    timestep_loss = F.l1_loss(new_states, batch_states[:, t, :])
+                elif loss_type == 'l2':
+                    # timestep_loss = F.mse_loss(pred_delta, label_delta)
+                    timestep_loss = F.mse_loss(new_states, batch_states[:, t, :])
+                elif loss_type == 'huber':
+                    # Note that the units our states are in will affect results
+                    # for Huber
+                    timestep_loss = F.smooth_l1_loss(
+                        batch_states[:, t, :], new_states)
+                elif loss_type == 'peter':
+                    # Use a Peter loss
+                    # Currently broken
+                    assert False
+
+                    pred_magnitude = torch.norm(pred_delta, dim=1)
+                    label_magnitude = torch.norm(label_delta, dim=1)
+                    assert pred_magnitude.shape == (N, )
+                    assert label_magnitude.shape == (N, )
+
+                    # pred_direction = pred_delta / (pred_magnitude + 1e-8)
+                    # label_direction = label_delta / (label_magnitude + 1e-8)
+                    # assert pred_direction.shape == (N, state_dim)
+                    # assert label_direction.shape == (N, state_dim)
+
+                    # Compute loss
+                    magnitude_loss = F.mse_loss(pred_magnitude, label_magnitude)
+                    # direction_loss =
+                    timestep_loss = magnitude_loss + direction_loss
+
+                    magnitude_losses.append(magnitude_loss)
+                    direction_losses.append(direction_loss)
+
+                else:
+                    assert False
+                loss_accum = loss_accum + timestep_loss
+
+                # Compute delta and update states
+                pred_deltas.append(torch.mean(
+                    (new_states - prev_states).detach() ** 2
+                ))
+                prev_states = new_states
+
+            pred_deltas = torch.stack(pred_deltas)
+            assert pred_deltas.shape == (timesteps - 1, )
+
+            loss = loss_accum / (timesteps - 1)
+        # Detach so we don't keep every batch's graph alive
+        epoch_losses.append(loss.detach())
         buddy.minimize(
             loss,
             optimizer_name=optim_name,
@@ -117,6 +163,8 @@ def train_dynamics_recurrent(buddy, pf_model, dataloader, log_interval=10,
             with buddy.log_scope(optim_name):
                 buddy.log("Training loss", loss)
 
+                label_deltas = utils.to_numpy(label_deltas)
+                pred_deltas = utils.to_numpy(pred_deltas)
                 buddy.log("Label delta mean", label_deltas.mean())
                 buddy.log("Label delta std", label_deltas.std())
 
@@ -130,7 +178,7 @@ def train_dynamics_recurrent(buddy, pf_model, dataloader, log_interval=10,
                     buddy.log("Direction loss",
                               torch.mean(torch.tensor(direction_losses)))
 
-    print("Epoch loss:", np.mean(utils.to_numpy(epoch_losses)))
+    print("Epoch loss:", torch.mean(torch.stack(epoch_losses)).item())
 
 
 def train_dynamics(buddy, pf_model, dataloader,
@@ -144,17 +192,16 @@ def train_dynamics(buddy, pf_model, dataloader,
         batch_gpu = utils.to_device(batch, buddy._device)
         prev_states, _unused_observations, controls, new_states = batch_gpu
 
-        prev_states += utils.to_torch(np.random.normal(
-            0, 0.05, size=prev_states.shape), device=buddy._device)
-        prev_states = prev_states[:, np.newaxis, :]
-        new_states_pred = pf_model.dynamics_model(
+        # Out-of-place, so we don't add noise to the dataset's own tensors
+        prev_states = prev_states + torch.randn_like(prev_states) * 0.05
+        new_states_pred = pf_model.dynamics_model.forward_flat(
             prev_states, controls, noisy=False)
-        new_states_pred = new_states_pred.squeeze(dim=1)
 
         mse_pos = F.mse_loss(new_states_pred, new_states)
         # mse_pos = torch.mean((new_states_pred - new_states) ** 2, axis=0)
         loss = mse_pos
-        losses.append(utils.to_numpy(loss))
+        # Detach instead of syncing to the CPU every batch
+        losses.append(loss.detach())
 
         buddy.minimize(
             loss,
@@ -179,7 +226,7 @@ def train_dynamics(buddy, pf_model, dataloader,
                 buddy.log("Predicted pos mean", pred_mean[0])
 
             # print(".", end="")
-    print("Epoch loss:", np.mean(losses))
+    print("Epoch loss:", torch.mean(torch.stack(losses)).item())
 
 
 def train_measurement(buddy, pf_model, dataloader,
@@ -199,7 +246,8 @@ def train_measurement(buddy, pf_model, dataloader,
         pred_likelihoods = pred_likelihoods.squeeze(dim=1)
 
         loss = torch.mean((pred_likelihoods - log_likelihoods) ** 2)
-        losses.append(utils.to_numpy(loss))
+        # Detach instead of syncing to the CPU every batch
+        losses.append(loss.detach())
 
         buddy.minimize(
             loss,
@@ -216,11 +264,20 @@ def train_measurement(buddy, pf_model, dataloader,
                 buddy.log("Label likelihoods mean", log_likelihoods.mean())
                 buddy.log("Label likelihoods std", log_likelihoods.std())
 
-    print("Epoch loss:", np.mean(losses))
+    print("Epoch loss:", torch.mean(torch.stack(losses)).item())
 
 
 def train_e2e(buddy, pf_model, dataloader, log_interval=2,
-              loss_type="mse", optim_name="e2e", resample=False, know_image_blackout=False):
+              loss_type="mse", optim_name="e2e", resample=False, know_image_blackout=False,
+              mixed_precision=False, compile_model=False):
+    # If `mixed_precision` is set, we run our particle filter in bfloat16
+    # autocast; losses are still computed in float32
+    device = torch.device(buddy._device)
+
+    # Our filter is called with the same shapes at every timestep, so it's a
+    # good fit for `torch.compile`
+    pf_forward = _compile_pf_model(pf_model) if compile_model else pf_model
+
     # Train for 1 epoch
     for batch_idx, batch in enumerate(tqdm(dataloader)):
         # Transfer to GPU and pull out batch data
@@ -235,32 +292,49 @@ def train_e2e(buddy, pf_model, dataloader, log_interval=2,
 
         # Give all particle equal weights
         particles = batch_particles
-        log_weights = torch.ones((N, M), device=buddy._device) * (-np.log(M))
+        log_weights = torch.full((N, M), -np.log(M), device=buddy._device)
+
+        # Observation features don't depend on our particles, so if our
+        # measurement model supports it we encode every timestep at once
+        # (N, timesteps - 1, obs_features)
+        observation_features = None
+        measurement_model = getattr(pf_model, "measurement_model", None)
+        if hasattr(measurement_model, "encode_observations"):
+            with torch.autocast(device_type=device.type, dtype=torch.bfloat16,
+                                enabled=mixed_precision):
+                observation_features = measurement_model.encode_observations(
+                    utils.DictIterator(batch_obs)[:, :-1])
+
+        # Split our observations into timesteps once, instead of indexing into
+        # every observation tensor at each step
+        # (N, timesteps, *) => timesteps * [(N, *)]
+        observations = [
+            dict(zip(batch_obs.keys(), obs_t))
+            for obs_t in zip(*[x.unbind(dim=1) for x in batch_obs.values()])]
 
         # Accumulate losses from each timestep
-        losses = []
+        loss_accum = torch.zeros((), device=buddy._device)
         for t in range(1, timesteps):
             prev_particles = particles
             prev_log_weights = log_weights
 
-            if know_image_blackout:
-                state_estimates, new_particles, new_log_weights = pf_model.forward(
-                    prev_particles,
-                    prev_log_weights,
-                    utils.DictIterator(batch_obs)[:, t - 1, :],
-                    batch_controls[:, t, :],
-                    resample=resample,
-                    noisy_dynamics=True,
-                    know_image_blackout=True
-                )
-            else:
-                state_estimates, new_particles, new_log_weights = pf_model.forward(
+            forward_kwargs = {}
+            if observation_features is not None:
+                forward_kwargs['observation_features'] = \
+                    observation_features[:, t - 1]
+            elif know_image_blackout:
+                forward_kwargs['know_image_blackout'] = True
+
+            with torch.autocast(device_type=device.type, dtype=torch.bfloat16,
+                                enabled=mixed_precision):
+                state_estimates, new_particles, new_log_weights = pf_forward(
                     prev_particles,
                     prev_log_weights,
-                    utils.DictIterator(batch_obs)[:, t - 1, :],
+                    observations[t - 1],
                     batch_controls[:, t, :],
                     resample=resample,
                     noisy_dynamics=True,
+                    **forward_kwargs
                 )
 
             if loss_type == "gmm":
@@ -276,7 +350,7 @@ def train_e2e(buddy, pf_model, dataloader, log_interval=2,
             else:
                 assert False, "Invalid loss"
 
-            losses.append(loss)
+            loss_accum = loss_accum + loss
 
             # Enable backprop through time
             particles = new_particles
@@ -288,24 +362,26 @@ def train_e2e(buddy, pf_model, dataloader, log_interval=2,
 
             # assert state_estimates.shape == batch_states[:, t, :].shape
 
+        loss = loss_accum / (timesteps - 1)
         buddy.minimize(
-            torch.mean(torch.stack(losses)),
+            loss,
             optimizer_name=optim_name,
             checkpoint_interval=1000)
 
         if buddy.optimizer_steps % log_interval == 0:
             with buddy.log_scope(optim_name):
-                buddy.log("Training loss", np.mean(utils.to_numpy(losses)))
+                buddy.log("Training loss", loss)
                 buddy.log("Log weights mean", log_weights.mean())
                 buddy.log("Log weights std", log_weights.std())
                 buddy.log("Particle states mean", particles.mean())
                 buddy.log("particle states std", particles.std())
 
-    print("Epoch loss:", np.mean(utils.to_numpy(losses)))
+    print("Epoch loss:", loss.item())
 
 
 def rollout(pf_model, trajectories, start_time=0, max_timesteps=300,
-            particle_count=100, noisy_dynamics=True, true_initial=False):
+            particle_count=100, noisy_dynamics=True, true_initial=False,
+            mixed_precision=False, compile_model=False):
     # To make things easier, we're going to cut all our trajectories to the
     # same length :)
     end_time = np.min([len(s) for s, _, _ in trajectories] +
@@ -319,58 +395,62 @@ def rollout(pf_model, trajectories, start_time=0, max_timesteps=300,
 
     device = next(pf_model.parameters()).device
 
-    particles = np.zeros((N, M, state_dim))
+    # Shapes are fixed for the whole rollout, so we can also capture CUDA
+    # graphs when compiling
+    pf_forward = _compile_pf_model(pf_model, mode="reduce-overhead") \
+        if compile_model else pf_model
+
+    # Sample initial particles directly on the device
+    particles = torch.zeros((N, M, state_dim), device=device)
     if true_initial:
-        for i in range(N):
-            particles[i, :] = trajectories[i][0][0]
-        particles += np.random.normal(0, 0.1, size=particles.shape)
+        particles += utils.to_torch(
+            np.array([states[0] for states, _, _ in trajectories]),
+            device=device)[:, np.newaxis, :]
+        particles.add_(torch.randn_like(particles) * 0.1)
     else:
         # Distribute initial particles randomly
-        particles += np.random.normal(0, 1.0, size=particles.shape)
-
-    # Populate the initial state estimate as just the estimate of our particles
-    # This is a little hacky
-    predicted_states = [[np.mean(particles[i], axis=0)]
-                        for i in range(len(trajectories))]
-
-    particles = utils.to_torch(particles, device=device)
-    log_weights = torch.ones((N, M), device=device) * (-np.log(M))
-
-    for t in tqdm(range(start_time + 1, end_time)):
-        s = []
-        o = {}
-        c = []
-        for i, traj in enumerate(trajectories):
-            states, observations, controls = traj
-
-            s.append(predicted_states[i][t - start_time - 1])
-            o_t = utils.DictIterator(observations)[t]
-            utils.DictIterator(o).append(o_t)
-            c.append(controls[t])
-
-        s = np.array(s)
-        utils.DictIterator(o).convert_to_numpy()
-        c = np.array(c)
-        (s, o, c) = utils.to_torch((s, o, c), device=device)
-
-        state_estimates, new_particles, new_log_weights = pf_model.forward(
-            particles,
-            log_weights,
-            o,
-            c,
-            resample=True,
-            noisy_dynamics=noisy_dynamics
-        )
-
-        particles = new_particles
-        log_weights = new_log_weights
-
-        for i in range(len(trajectories)):
-            predicted_states[i].append(
-                utils.to_numpy(
-                    state_estimates[i]))
-
-    predicted_states = np.array(predicted_states)
+        particles.add_(torch.randn_like(particles) * 1.0)
+
+    # We never backpropagate through rollouts
+    with torch.inference_mode():
+        # (N, t, *)
+        (all_observations, all_controls) = utility.stack_trajectories(
+            trajectories, start_time, end_time, device)
+
+        log_weights = torch.full((N, M), -np.log(M), device=device)
+
+        # Preallocate our outputs on the device; we copy them back once at
+        # the end of the rollout instead of syncing every timestep
+        # (N, t, state_dim)
+        predicted_states = torch.empty(
+            (N, end_time - start_time, state_dim), device=device)
+
+        # Populate the initial state estimate as just the estimate of our
+        # particles
+        # This is a little hacky
+        predicted_states[:, 0] = torch.mean(particles, dim=1)
+
+        for t in tqdm(range(start_time + 1, end_time)):
+            o = utils.DictIterator(all_observations)[:, t - start_time]
+            c = all_controls[:, t - start_time]
+
+            with torch.autocast(device_type=device.type, dtype=torch.bfloat16,
+                                enabled=mixed_precision):
+                state_estimates, new_particles, new_log_weights = pf_forward(
+                    particles,
+                    log_weights,
+                    o,
+                    c,
+                    resample=True,
+                    noisy_dynamics=noisy_dynamics
+                )
+
+            particles = new_particles
+            log_weights = new_log_weights
+
+            predicted_states[:, t - start_time] = state_estimates
+
+    predicted_states = utils.to_numpy(predicted_states)
     actual_states = np.array(actual_states)
     return predicted_states, actual_states
 
@@ -427,7 +507,8 @@ def eval_rollout(predicted_states, actual_states, plot=False):
 
 
 def rollout_and_eval(pf_model, trajectories, start_time=0, max_timesteps=300,
-                     particle_count=100, noisy_dynamics=True, true_initial=False):
+                     particle_count=100, noisy_dynamics=True, true_initial=False,
+                     mixed_precision=False, compile_model=False):
     # To make things easier, we're going to cut all our trajectories to the
     # same length :)
     end_time = np.min([len(s) for s, _, _ in trajectories] +
@@ -441,72 +522,74 @@ def rollout_and_eval(pf_model, trajectories, start_time=0, max_timesteps=300,
 
     device = next(pf_model.parameters()).device
 
-    particles = np.zeros((N, M, state_dim))
+    # Shapes are fixed for the whole rollout, so we can also capture CUDA
+    # graphs when compiling
+    pf_forward = _compile_pf_model(pf_model, mode="reduce-overhead") \
+        if compile_model else pf_model
+
+    # Sample initial particles directly on the device
+    particles = torch.zeros((N, M, state_dim), device=device)
     if true_initial:
-        for i in range(N):
-            particles[i, :] = trajectories[i][0][0]
-        particles += np.random.normal(0, 0.2, size=[N, 1, state_dim])
-        particles += np.random.normal(0, 0.2, size=particles.shape)
+        particles += utils.to_torch(
+            np.array([states[0] for states, _, _ in trajectories]),
+            device=device)[:, np.newaxis, :]
+        particles.add_(torch.randn((N, 1, state_dim), device=device) * 0.2)
+        particles.add_(torch.randn_like(particles) * 0.2)
     else:
         # Distribute initial particles randomly
-        particles += np.random.normal(0, 1.0, size=particles.shape)
-
-    # Populate the initial state estimate as just the estimate of our particles
-    # This is a little hacky
-    # (N, t, state_dim)
-    predicted_states = [[np.mean(particles[i], axis=0)]
-                        for i in range(len(trajectories))]
-
-    particles = utils.to_torch(particles, device=device)
-    log_weights = torch.ones((N, M), device=device) * (-np.log(M))
-
-    # (N, t, M, state_dim)
-    particles_history = []
-    # (N, t, M)
-    weights_history = []
-
-    for i in range(N):
-        particles_history.append([utils.to_numpy(particles[i])])
-        weights_history.append([utils.to_numpy(log_weights[i])])
-
-    for t in tqdm(range(start_time + 1, end_time)):
-        s = []
-        o = {}
-        c = []
-        for i, traj in enumerate(trajectories):
-            states, observations, controls = traj
-
-            s.append(predicted_states[i][t - start_time - 1])
-            o_t = utils.DictIterator(observations)[t]
-            utils.DictIterator(o).append(o_t)
-            c.append(controls[t])
-
-        s = np.array(s)
-        utils.DictIterator(o).convert_to_numpy()
-        c = np.array(c)
-        (s, o, c) = utils.to_torch((s, o, c), device=device)
-
-        state_estimates, new_particles, new_log_weights = pf_model.forward(
-            particles,
-            log_weights,
-            o,
-            c,
-            resample=True,
-            noisy_dynamics=noisy_dynamics
-        )
-
-        particles = new_particles
-        log_weights = new_log_weights
-
-        for i in range(len(trajectories)):
-            predicted_states[i].append(
-                utils.to_numpy(
-                    state_estimates[i]))
-
-            particles_history[i].append(utils.to_numpy(particles[i]))
-            weights_history[i].append(np.exp(utils.to_numpy(log_weights[i])))
-
-    predicted_states = np.array(predicted_states)
+        particles.add_(torch.randn_like(particles) * 1.0)
+
+    # We never backpropagate through rollouts
+    with torch.inference_mode():
+        # (N, t, *)
+        (all_observations, all_controls) = utility.stack_trajectories(
+            trajectories, start_time, end_time, device)
+
+        log_weights = torch.full((N, M), -np.log(M), device=device)
+
+        # Preallocate our outputs on the device; we copy them back once at
+        # the end of the rollout instead of syncing every timestep
+        timesteps = end_time - start_time
+        # (N, t, state_dim)
+        predicted_states = torch.empty(
+            (N, timesteps, state_dim), device=device)
+        # (N, t, M, state_dim)
+        particles_history = torch.empty(
+            (N, timesteps, M, state_dim), device=device)
+        # (N, t, M)
+        weights_history = torch.empty((N, timesteps, M), device=device)
+
+        # Populate the initial state estimate as just the estimate of our
+        # particles
+        # This is a little hacky
+        predicted_states[:, 0] = torch.mean(particles, dim=1)
+        particles_history[:, 0] = particles
+        weights_history[:, 0] = log_weights
+
+        for t in tqdm(range(start_time + 1, end_time)):
+            o = utils.DictIterator(all_observations)[:, t - start_time]
+            c = all_controls[:, t - start_time]
+
+            with torch.autocast(device_type=device.type, dtype=torch.bfloat16,
+                                enabled=mixed_precision):
+                state_estimates, new_particles, new_log_weights = pf_forward(
+                    particles,
+                    log_weights,
+                    o,
+                    c,
+                    resample=True,
+                    noisy_dynamics=noisy_dynamics
+                )
+
+            particles = new_particles
+            log_weights = new_log_weights
+
+            predicted_states[:, t - start_time] = state_estimates
+            particles_history[:, t - start_time] = particles
+            weights_history[:, t - start_time] = torch.exp(log_weights)
+
+    (predicted_states, particles_history, weights_history) = utils.to_numpy(
+        (predicted_states, particles_history, weights_history))
     actual_states = np.array(actual_states)
 
     ### Eval
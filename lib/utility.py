@@ -1,5 +1,6 @@
 import torch
 import numpy as np
+from fannypack import utils
 
 def diag_to_vector(m):
     assert m.shape[-1] == m.shape[-2] # make sure it's square matrix
@@ -34,4 +35,22 @@ def denormalize_state(state, state_sigma, mean=[0.4970164, -0.00916641], std=[0.
 
 def denormalize(x, mean, std):
 
-    return np.array(x)*np.array(std)+np.array(mean)
\ No newline at end of file
+    return np.array(x)*np.array(std)+np.array(mean)
+
+
+def stack_trajectories(trajectories, start_time, end_time, device):
+    """Stack the observations and controls of a list of (states, observations,
+    controls) trajectories on the device, so each timestep is just a slice.
+
+    Returns:
+        observations (dict): (N, end_time - start_time, *) observations
+        controls (torch.Tensor): (N, end_time - start_time, control_dim)
+    """
+    observations = {}
+    for _, trajectory_observations, _ in trajectories:
+        utils.DictIterator(observations).append(
+            utils.DictIterator(trajectory_observations)[start_time:end_time])
+    utils.DictIterator(observations).convert_to_numpy()
+    controls = np.array([trajectory_controls[start_time:end_time]
+                         for _, _, trajectory_controls in trajectories])
+    return utils.to_torch((observations, controls), device=device)